@@ -7,45 +7,75 @@ Autonomous Email Agent
 
 import imaplib
 import re
+import select
 import smtplib
 import email
+import email.policy
 import email.utils
+import datetime
+import functools
+import itertools
+import hashlib
+import io
+import zlib
 import ssl
+import threading
 import time
+import atexit
 import uuid
 import logging
 import argparse
+import asyncio
+import base64
+import quopri
 import importlib.util
 import json
+import os
+import sqlite3
 import urllib.request
 from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from email.generator import BytesGenerator
 from email.header import decode_header
+from collections import OrderedDict, deque
 from typing import TypedDict, Annotated
 from langgraph.graph import StateGraph, END
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage
 
-logging.basicConfig(level=logging.DEBUG)
+try:
+    import fast_mail_parser
+except ImportError:  # optional native parser; fall back to the stdlib email package
+    fast_mail_parser = None
+
+logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
-# Config and llm are initialised by load_config() before run() is called.
+# Config, the LLMs and the reply cache are initialised by load_config() before run() is called.
 Config = None
 llm = None
+llm_small = None  # cheaper model for short emails; same as llm unless LLM_MODEL_SMALL is set
+_reply_cache = None
 
 
 def load_config(path: str) -> None:
-    """Load a config file by path and initialise Config + llm."""
-    global Config, llm
+    """Load a config file by path and initialise Config, the LLMs and the reply cache."""
+    global Config, llm, llm_small, _reply_cache
     spec = importlib.util.spec_from_file_location("config", path)
     module = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(module)
     Config = module.Config
-    llm = ChatOpenAI(
-        model=Config.LLM_MODEL,
-        api_key=Config.ANTHROPIC_AUTH_TOKEN,
-        base_url=Config.ANTHROPIC_BASE_URL + "/v1" if Config.ANTHROPIC_BASE_URL else None,
-    )
+
+    def make_llm(model: str) -> ChatOpenAI:
+        return ChatOpenAI(
+            model=model,
+            api_key=Config.ANTHROPIC_AUTH_TOKEN,
+            base_url=Config.ANTHROPIC_BASE_URL + "/v1" if Config.ANTHROPIC_BASE_URL else None,
+        )
+
+    llm = make_llm(Config.LLM_MODEL)
+    small_model = getattr(Config, "LLM_MODEL_SMALL", "")
+    llm_small = make_llm(small_model) if small_model else llm
+    _reply_cache = _ReplyCache(getattr(Config, "REPLY_CACHE_PATH", DEFAULT_REPLY_CACHE_PATH))
     log.info(f"Loaded config from {path}")
 
 
@@ -60,14 +90,22 @@ class EmailState(TypedDict):
     references: str       # References header of the incoming email (space-separated IDs)
     thread_history: str
     is_auto_reply: bool
+    raw_headers: frozenset  # lower-cased header names of the incoming email
     should_reply: bool
+    dedup_key: str          # reply-cache key of the incoming email
     reply_body: str
     error: str
 
 
 # ── Document Context ─────────────────────────────────────────────────────────
 
-def fetch_document_context(subject: str, body: str) -> str:
+def _read_url(url: str) -> str:
+    req = urllib.request.Request(url, headers={"User-Agent": "Majordomo-Agent/1.0"})
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return resp.read().decode("utf-8", errors="replace")
+
+
+async def fetch_document_context(subject: str, body: str) -> str:
     """
     If Config.DOCUMENTS is defined, ask the LLM which documents are relevant to
     this email, fetch their URLs, and return the combined content as a string
@@ -94,7 +132,7 @@ def fetch_document_context(subject: str, body: str) -> str:
         f"Example: [\"doc1\", \"doc3\"]"
     )
     try:
-        selection_result = llm.invoke([
+        selection_result = await llm.ainvoke([
             SystemMessage(content="You select relevant reference documents for an email agent. Output only valid JSON."),
             HumanMessage(content=selector_prompt),
         ])
@@ -115,23 +153,29 @@ def fetch_document_context(subject: str, body: str) -> str:
         log.debug("[docs] No relevant documents selected.")
         return ""
 
-    fetched_sections = []
+    selected_docs = []
     for doc_name in selected_indices:
         doc = next((d for d in documents if d["name"] == doc_name), None)
         if not doc:
             log.debug(f"[docs] No document found with name: {doc_name!r}")
             continue
+        selected_docs.append(doc)
+
+    async def fetch(doc):
         url = doc["url"]
         description = doc["description"]
         log.debug(f"[docs] Fetching '{description}' from {url}")
         try:
-            req = urllib.request.Request(url, headers={"User-Agent": "Majordomo-Agent/1.0"})
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                content = resp.read().decode("utf-8", errors="replace")
+            content = await asyncio.to_thread(_read_url, url)
             log.info(f"[docs] Fetched '{description}' from {url} ({len(content)} chars)")
-            fetched_sections.append(f"--- Reference: {description} ({url}) ---\n{content}")
+            return f"--- Reference: {description} ({url}) ---\n{content}"
         except Exception as e:
             log.warning(f"[docs] Failed to fetch '{description}' from {url}: {e}")
+            return None
+
+    # Fetch all selected documents concurrently
+    fetched = await asyncio.gather(*(fetch(doc) for doc in selected_docs))
+    fetched_sections = [section for section in fetched if section]
 
     if not fetched_sections:
         log.debug("[docs] All fetches failed or returned nothing.")
@@ -141,93 +185,292 @@ def fetch_document_context(subject: str, body: str) -> str:
     return "\n\n".join(fetched_sections)
 
 
+# ── SMTP Connection Pool ──────────────────────────────────────────────────────
+
+SMTP_IDLE_TIMEOUT_SECONDS = 100
+
+
+class _SMTPPool:
+    """
+    Keep one authenticated SMTP_SSL connection per (host, port, user) alive
+    between replies, so bursts of replies pay for TLS + LOGIN only once.
+    """
+
+    def __init__(self, idle_timeout: float = SMTP_IDLE_TIMEOUT_SECONDS):
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle: dict[tuple, tuple[smtplib.SMTP_SSL, float]] = {}  # key -> (server, last used)
+        self._warming: set[tuple] = set()
+
+    @staticmethod
+    def _key() -> tuple:
+        return (Config.SMTP_HOST, Config.SMTP_PORT, Config.EMAIL_ADDRESS)
+
+    @staticmethod
+    def _close(server) -> None:
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def get(self) -> smtplib.SMTP_SSL:
+        """Return a live, logged-in connection, reconnecting if the cached one went stale."""
+        with self._lock:
+            server, last_used = self._idle.pop(self._key(), (None, 0.0))
+        if server is not None:
+            if time.monotonic() - last_used > self._idle_timeout:
+                self._close(server)
+                server = None
+            else:
+                try:
+                    if server.noop()[0] != 250:
+                        raise smtplib.SMTPServerDisconnected("NOOP failed")
+                except (smtplib.SMTPException, OSError):
+                    log.debug("[smtp] Cached connection is dead, reconnecting")
+                    server.close()
+                    server = None
+        if server is None:
+            server = smtplib.SMTP_SSL(Config.SMTP_HOST, Config.SMTP_PORT)
+            server.login(Config.EMAIL_ADDRESS, Config.EMAIL_PASSWORD)
+            log.debug(f"[smtp] Connected to {Config.SMTP_HOST}:{Config.SMTP_PORT}")
+        return server
+
+    def warm(self) -> None:
+        """Log in ahead of time so the next get() finds a live connection; errors are only logged."""
+        key = self._key()
+        with self._lock:
+            idle = self._idle.get(key)
+            if key in self._warming or (idle and time.monotonic() - idle[1] < self._idle_timeout):
+                return
+            self._warming.add(key)
+        try:
+            server = smtplib.SMTP_SSL(Config.SMTP_HOST, Config.SMTP_PORT)
+            server.login(Config.EMAIL_ADDRESS, Config.EMAIL_PASSWORD)
+            log.debug(f"[smtp] Pre-connected to {Config.SMTP_HOST}:{Config.SMTP_PORT}")
+            self.release(server)
+        except Exception as e:
+            log.debug(f"[smtp] Pre-connect failed: {e}")
+        finally:
+            with self._lock:
+                self._warming.discard(key)
+
+    def release(self, server) -> None:
+        """Return a connection to the pool; an extra one for the same key is closed."""
+        with self._lock:
+            previous = self._idle.get(self._key())
+            self._idle[self._key()] = (server, time.monotonic())
+        if previous is not None:
+            self._close(previous[0])
+
+    def close_all(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for server, _ in idle.values():
+            self._close(server)
+
+
+_smtp_pool = _SMTPPool()
+atexit.register(_smtp_pool.close_all)
+
+
+# ── Reply Cache ───────────────────────────────────────────────────────────────
+
+DEFAULT_REPLY_CACHE_PATH = os.path.expanduser("~/.majordomo/reply_cache.sqlite")
+REPLY_CACHE_TTL_SECONDS = 24 * 3600
+
+_SUBJECT_PREFIX_RE = re.compile(r"(?i)^\s*((re|fwd?|aw)\s*:\s*)+")
+
+
+def reply_cache_key(sender: str, subject: str, body: str, thread_history: str) -> str:
+    """
+    Digest of (sender address, subject, start of body, thread history), normalised so
+    resends and echoes collide. The reply is personalised and depends on the thread,
+    so it is only ever reused for the same person in the same conversation.
+    """
+    address = email.utils.parseaddr(sender)[1].lower()
+    subject = _SUBJECT_PREFIX_RE.sub("", subject).strip().lower()
+    body = " ".join(body.split()).lower()[:2048]
+    return hashlib.blake2b(
+        "\0".join((address, subject, body, thread_history)).encode(), digest_size=16
+    ).hexdigest()
+
+
+class _ReplyCache:
+    """
+    Replies sent in the last REPLY_CACHE_TTL_SECONDS, keyed by reply_cache_key(),
+    so a duplicate email reuses the earlier reply instead of calling the LLM.
+    Backed by SQLite so it survives restarts.
+    """
+
+    def __init__(self, path: str, ttl: float = REPLY_CACHE_TTL_SECONDS):
+        if path != ":memory:":
+            path = os.path.expanduser(path)
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS replies (key TEXT PRIMARY KEY, sent_at REAL, reply_body TEXT)")
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT reply_body FROM replies WHERE key = ? AND sent_at >= ?",
+                (key, time.time() - self._ttl),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, reply_body: str) -> None:
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM replies WHERE sent_at < ?", (now - self._ttl,))
+            self._db.execute("INSERT OR REPLACE INTO replies VALUES (?, ?, ?)", (key, now, reply_body))
+
+
 # ── Graph Nodes ───────────────────────────────────────────────────────────────
 
 def triage(state: EmailState) -> EmailState:
-    """Decide whether this email warrants a reply based on auto-reply headers."""
-    state["should_reply"] = not state["is_auto_reply"]
-    log.info(f"Triage for '{state['subject']}': {'REPLY' if state['should_reply'] else 'SKIP (auto-reply)'}")
+    """Decide whether this email warrants a reply using cheap rules, before any LLM call."""
+    if state["is_auto_reply"]:
+        skip_reason = "auto-reply"
+    elif NO_REPLY_RE.search(email.utils.parseaddr(state["sender"])[1]):
+        skip_reason = "no-reply sender"
+    elif "list-unsubscribe" in state["raw_headers"]:
+        skip_reason = "mailing list"
+    elif NON_REPLY_SUBJECT_RE.search(state["subject"]):
+        skip_reason = "automated subject"
+    else:
+        skip_reason = ""
+    state["should_reply"] = not skip_reason
+    log.info(f"Triage for '{state['subject']}': {'REPLY' if state['should_reply'] else f'SKIP ({skip_reason})'}")
+    return state
+
+
+def check_duplicate(state: EmailState) -> EmailState:
+    """Reuse the reply to an identical email answered recently instead of calling the LLM."""
+    state["dedup_key"] = reply_cache_key(state["sender"], state["subject"], state["body"], state["thread_history"])
+    cached = _reply_cache.get(state["dedup_key"])
+    if cached is not None:
+        log.info(f"Duplicate of a recently answered email; reusing reply for '{state['subject']}'")
+        state["reply_body"] = cached
     return state
 
 
-def generate_reply(state: EmailState) -> EmailState:
+SMALL_MODEL_MAX_CHARS = 2000
+
+
+async def generate_reply(state: EmailState) -> EmailState:
     """Generate a reply to the email."""
     if not state["should_reply"]:
         return state
 
-    thread_section = ""
-    if state["thread_history"]:
-        thread_section = f"\nPrevious thread context:\n{state['thread_history']}\n"
+    # Everything static lives in the system message so providers that cache prompt
+    # prefixes automatically can reuse it; the per-email fields follow in a fixed order.
+    system_prompt = f"""{Config.AGENT_PERSONA}
 
-    doc_context = fetch_document_context(state["subject"], state["body"])
-    doc_section = ""
-    if doc_context:
-        doc_section = f"\nRelevant reference documents:\n{doc_context}\n"
+Write a helpful, professional reply. Be concise. Do not use filler phrases like
+"I hope this email finds you well." Sign off as: {Config.AGENT_NAME}
 
-    prompt = f"""
-{thread_section}
-{doc_section}
-You received this email:
+Write only the email body, no subject line."""
+
+    prompt = f"""You received this email:
 FROM: {state['sender']}
 SUBJECT: {state['subject']}
 BODY:
 {state['body']}
+"""
+    if state["thread_history"]:
+        prompt += f"\nTHREAD_HISTORY:\n{state['thread_history']}\n"
 
-Write a helpful, professional reply. Be concise. Do not use filler phrases like 
-"I hope this email finds you well." Sign off as: {Config.AGENT_NAME}
-
-Write only the email body, no subject line."""
-    
-    print(prompt)
-
-    result = llm.invoke([
-        SystemMessage(content=Config.AGENT_PERSONA),
-        HumanMessage(content=prompt)
-    ])
-    state["reply_body"] = result.content.strip()
+    doc_context = await fetch_document_context(state["subject"], state["body"])
+    if doc_context:
+        prompt += f"\nRelevant reference documents:\n{doc_context}\n"
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Prompt: %s", prompt)
+
+    # Open and authenticate the SMTP connection while the reply is being generated,
+    # so send_reply doesn't pay for TLS + LOGIN after the LLM finishes
+    warm_smtp = asyncio.create_task(asyncio.to_thread(_smtp_pool.warm))
+    # Short emails without much history are answered by the cheaper model
+    is_short = len(state["body"]) + len(state["thread_history"]) < SMALL_MODEL_MAX_CHARS
+    model = llm_small if is_short else llm
+    if getattr(Config, "PROMPT_CACHE_CONTROL", False):
+        # Anthropic-style explicit cache breakpoint; not part of the OpenAI chat schema
+        system_message = SystemMessage(content=[
+            {"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}
+        ])
+    else:
+        system_message = SystemMessage(content=system_prompt)
+    try:
+        result = None
+        async for chunk in model.astream([
+            system_message,
+            HumanMessage(content=prompt)
+        ]):
+            result = chunk if result is None else result + chunk
+    finally:
+        await warm_smtp
+    state["reply_body"] = result.content.strip() if result is not None else ""
     return state
 
 
+_FOLD_RE = re.compile(r"[\r\n]+[ \t]*")
+
+
+def _unfold(value: str) -> str:
+    """Join a folded header value back onto one line (RFC 5322 §2.2.3)."""
+    return _FOLD_RE.sub(" ", value).strip()
+
+
 def send_reply(state: EmailState) -> EmailState:
     """Send the generated reply via SMTP and copy it to the sent folder via IMAP."""
     if not state["should_reply"] or not state["reply_body"]:
         return state
 
     try:
-        msg = MIMEMultipart()
+        # Replies are always a single text part: no multipart wrapper needed
+        msg = MIMEText(state["reply_body"], "plain", "utf-8", policy=email.policy.SMTP)
         msg["Message-ID"] = email.utils.make_msgid(domain=Config.SMTP_HOST)
         msg["Date"] = email.utils.formatdate(localtime=True)
         msg["From"] = Config.EMAIL_ADDRESS
-        msg["To"] = state["sender"]
-        msg["Subject"] = f"Re: {state['subject']}"
+        # Values copied from the incoming email may still be folded across lines,
+        # which the SMTP policy refuses in header values
+        recipient = _unfold(state["sender"])
+        msg["To"] = recipient
+        msg["Subject"] = f"Re: {_unfold(state['subject'])}"
         msg["Auto-Submitted"] = "auto-replied"
         # Thread headers: link this reply into the conversation chain
-        if state["message_id"]:
-            msg["In-Reply-To"] = state["message_id"]
+        message_id = " ".join(state["message_id"].split())
+        if message_id:
+            msg["In-Reply-To"] = message_id
             # References = existing chain + the message we're replying to
-            prior_refs = state["references"].strip() if state["references"] else ""
-            new_refs = (prior_refs + " " + state["message_id"]).strip()
+            prior_refs = " ".join(state["references"].split()) if state["references"] else ""
+            new_refs = (prior_refs + " " + message_id).strip()
             msg["References"] = new_refs
-        msg.attach(MIMEText(state["reply_body"], "plain"))
-        raw = msg.as_bytes()
-
-        with smtplib.SMTP_SSL(Config.SMTP_HOST, Config.SMTP_PORT) as server:
-            server.login(Config.EMAIL_ADDRESS, Config.EMAIL_PASSWORD)
-            server.sendmail(Config.EMAIL_ADDRESS, state["sender"], raw)
-
-        log.info(f"Replied to {state['sender']} re: '{state['subject']}'")
+        buf = io.BytesIO()
+        BytesGenerator(buf, policy=email.policy.SMTP, mangle_from_=False).flatten(msg)
+        raw = buf.getvalue()
 
-        # Copy to sent folder if one was detected at startup
-        if len(_folders_to_search) > 1:
-            sent_folder = _folders_to_search[1]
-            try:
-                ctx = ssl.create_default_context()
-                with imaplib.IMAP4_SSL(Config.IMAP_HOST, Config.IMAP_PORT, ssl_context=ctx) as imap:
-                    imap.login(Config.EMAIL_ADDRESS, Config.EMAIL_PASSWORD)
-                    imap.append(sent_folder, "\\Seen", imaplib.Time2Internaldate(time.time()), raw)
-                log.info(f"Copied reply to {sent_folder}")
-            except Exception as e:
-                log.warning(f"Failed to copy reply to sent folder: {e}")
+        server = _smtp_pool.get()
+        try:
+            server.sendmail(Config.EMAIL_ADDRESS, recipient, raw)
+        finally:
+            _smtp_pool.release(server)
+
+        log.info(f"Replied to {recipient} re: '{_unfold(state['subject'])}'")
+        if state["dedup_key"]:
+            _reply_cache.put(state["dedup_key"], state["reply_body"])
+        _remember_thread_message(
+            str(msg["Message-ID"]), str(msg["Date"]), Config.EMAIL_ADDRESS, state["reply_body"],
+            _MSGID_RE.findall(msg["References"] or ""),
+        )
+
+        # Copy to sent folder if one was detected at login
+        try:
+            if imap_session.append_sent(raw):
+                log.info(f"Copied reply to {imap_session.sent_folder}")
+        except Exception as e:
+            log.warning(f"Failed to copy reply to sent folder: {e}")
 
     except Exception as e:
         state["error"] = str(e)
@@ -237,7 +480,11 @@ def send_reply(state: EmailState) -> EmailState:
 
 
 def route_after_triage(state: EmailState) -> str:
-    return "generate_reply" if state["should_reply"] else END
+    return "check_duplicate" if state["should_reply"] else END
+
+
+def route_after_check_duplicate(state: EmailState) -> str:
+    return "send_reply" if state["reply_body"] else "generate_reply"
 
 
 # ── Build Graph ────────────────────────────────────────────────────────────────
@@ -245,11 +492,13 @@ def route_after_triage(state: EmailState) -> str:
 def build_graph():
     graph = StateGraph(EmailState)
     graph.add_node("triage", triage)
+    graph.add_node("check_duplicate", check_duplicate)
     graph.add_node("generate_reply", generate_reply)
     graph.add_node("send_reply", send_reply)
 
     graph.set_entry_point("triage")
     graph.add_conditional_edges("triage", route_after_triage)
+    graph.add_conditional_edges("check_duplicate", route_after_check_duplicate)
     graph.add_edge("generate_reply", "send_reply")
     graph.add_edge("send_reply", END)
 
@@ -264,6 +513,11 @@ agent = build_graph()
 def decode_str(value):
     if not value:
         return ""
+    return _decode_header_str(str(value))
+
+
+@functools.lru_cache(maxsize=1024)
+def _decode_header_str(value: str) -> str:
     parts = decode_header(value)
     return "".join(
         part.decode(enc or "utf-8") if isinstance(part, bytes) else part
@@ -271,16 +525,64 @@ def decode_str(value):
     )
 
 
-def get_body(msg):
+class ParsedEmail:
+    """Header dict + first text/plain body of a fetched message."""
+
+    def __init__(self, headers, text_body: str, headers_decoded: bool = False):
+        # Header names are case-insensitive; the first occurrence wins, like Message.get()
+        self.headers: dict[str, str] = {}
+        for name, value in headers:
+            self.headers.setdefault(name.lower(), value)
+        self.text_body = text_body
+        self.headers_decoded = headers_decoded  # True if RFC 2047 words are already decoded
+
+    def get(self, name: str, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def __getitem__(self, name: str):
+        return self.headers.get(name.lower())
+
+
+def _stdlib_text_body(msg) -> str:
     if msg.is_multipart():
-        for part in msg.walk():
-            if part.get_content_type() == "text/plain":
-                return part.get_payload(decode=True).decode("utf-8", errors="replace")
+        # Like fast_mail_parser: the first text/plain part, else the first text/html one
+        for content_type in ("text/plain", "text/html"):
+            for part in msg.walk():
+                if part.get_content_type() == content_type:
+                    return part.get_payload(decode=True).decode("utf-8", errors="replace")
     else:
         return msg.get_payload(decode=True).decode("utf-8", errors="replace")
     return ""
 
 
+def _parse(raw: bytes) -> ParsedEmail:
+    """Parse an RFC822 blob, using fast_mail_parser when available."""
+    if fast_mail_parser is not None:
+        try:
+            mail = fast_mail_parser.parse_email(raw)
+            # Like the stdlib path, an HTML-only email yields its HTML rather than nothing
+            bodies = mail.text_plain or mail.text_html
+            return ParsedEmail(
+                ((name, values[0]) for name, values in mail.headers.items() if values),
+                bodies[0] if bodies else "",
+                headers_decoded=True,
+            )
+        except Exception as e:
+            log.debug(f"fast_mail_parser failed, falling back to stdlib: {e}")
+    msg = email.message_from_bytes(raw)
+    return ParsedEmail(msg.items(), _stdlib_text_body(msg))
+
+
+def decoded_header(msg: ParsedEmail, name: str) -> str:
+    """Header value with RFC 2047 encoded words decoded, unless the parser already did."""
+    value = msg.get(name, "") or ""
+    return value if msg.headers_decoded else decode_str(value)
+
+
+def get_body(msg: ParsedEmail) -> str:
+    return msg.text_body
+
+
 AUTO_REPLY_HEADERS = {
     "auto-submitted",
     "x-auto-response-suppress",
@@ -289,6 +591,13 @@ AUTO_REPLY_HEADERS = {
 }
 AUTO_REPLY_PRECEDENCE = {"bulk", "list", "auto_reply", "junk"}
 
+# Senders and subjects that never expect an answer
+NO_REPLY_RE = re.compile(r"(?i)^(no[-_.]?reply|mailer-daemon|postmaster|bounces?|do[-_.]?not[-_.]?reply)@")
+NON_REPLY_SUBJECT_RE = re.compile(
+    r"(?i)^\s*(auto(matic)?[- ]?reply|out of (the )?office|undeliver(able|ed)|"
+    r"delivery status notification|mail delivery (failed|failure|subsystem)|returned mail)"
+)
+
 
 def is_auto_reply_email(msg) -> bool:
     """Return True if the message contains standard auto-reply headers."""
@@ -307,28 +616,247 @@ def is_auto_reply_email(msg) -> bool:
 # Common sent-folder candidates to probe at startup
 _SENT_FOLDER_CANDIDATES = ["Sent", "Sent Items", "Sent Messages", "[Gmail]/Sent Mail", "INBOX.Sent", "SENT"]
 
-# Resolved at startup; populated by detect_folders()
-_folders_to_search: list[str] = ["INBOX"]
-
-
-def detect_folders(imap) -> None:
-    """Probe the server once to find which sent folder exists and cache it."""
-    global _folders_to_search
+def detect_folders(imap) -> list[str]:
+    """Probe the server to find which sent folder exists; return the folders to search."""
     for candidate in _SENT_FOLDER_CANDIDATES:
         try:
             status, _ = imap.select(candidate, readonly=True)
             if status == "OK":
                 log.info(f"Sent folder detected: {candidate}")
-                _folders_to_search = ["INBOX", candidate]
                 imap.select("INBOX")
-                return
+                return ["INBOX", candidate]
         except Exception:
             continue
     log.warning("No sent folder detected; thread history will only search INBOX.")
-    _folders_to_search = ["INBOX"]
+    return ["INBOX"]
+
+
+def supports_idle(imap) -> bool:
+    """Ask for the post-login capabilities; servers often only advertise IDLE after LOGIN."""
+    _, data = imap.capability()
+    return b"IDLE" in data[-1].upper().split()
+
+
+class ImapSession:
+    """
+    The long-lived IMAP connection shared by the main loop and send_reply,
+    together with what was detected on it at login.
+    """
+
+    def __init__(self):
+        self.imap = None
+        self.folders: list[str] = ["INBOX"]
+        self.use_idle = False
+        self.highest_uid = 0  # highest INBOX UID returned by an UNSEEN search so far
+        self._lock = threading.Lock()
+
+    @property
+    def sent_folder(self) -> str | None:
+        return self.folders[1] if len(self.folders) > 1 else None
+
+    def connect(self):
+        """Return the cached connection, logging in and probing folders if there is none."""
+        if self.imap is None:
+            ctx = ssl.create_default_context()
+            imap = imaplib.IMAP4_SSL(Config.IMAP_HOST, Config.IMAP_PORT, ssl_context=ctx)
+            imap.login(Config.EMAIL_ADDRESS, Config.EMAIL_PASSWORD)
+            self.folders = detect_folders(imap)
+            self.use_idle = supports_idle(imap)
+            self.imap = imap
+            log.info(f"Connected to {Config.IMAP_HOST} ({'IDLE' if self.use_idle else 'polling'})")
+        return self.imap
+
+    def drop(self) -> None:
+        """Discard the cached connection after an error; the next connect() logs in again."""
+        imap, self.imap = self.imap, None
+        if imap is not None:
+            try:
+                imap.logout()
+            except Exception:
+                pass
+
+    def append_sent(self, raw: bytes) -> bool:
+        """Copy a sent message to the sent folder. Returns False if there is no sent folder."""
+        with self._lock:
+            try:
+                imap = self.connect()
+                if self.sent_folder is None:
+                    return False
+                imap.append(self.sent_folder, "\\Seen", imaplib.Time2Internaldate(time.time()), raw)
+            except (imaplib.IMAP4.abort, imaplib.IMAP4.error, OSError):
+                self.drop()
+                raise
+        return True
+
+
+imap_session = ImapSession()
+
+
+# Messages are fetched as headers + the start of the body rather than RFC822, so
+# attachments are never downloaded; PEEK also leaves \Seen flags untouched.
+BODY_FETCH_BYTES = 65536
+
+
+def _peek_fetch_items(text_bytes: int = BODY_FETCH_BYTES) -> str:
+    return f"(BODY.PEEK[HEADER] BODY.PEEK[TEXT]<0.{text_bytes}>)"
+
+
+_FETCH_START_RE = re.compile(rb"^\d+ \(")
+_FETCH_UID_RE = re.compile(rb"\bUID (\d+)")
+
+
+def split_fetch_response(data) -> list[tuple[bytes, list[bytes]]]:
+    """
+    Group the data of a multi-message FETCH into one (metadata, literals) pair
+    per message. imaplib returns every literal as a (prefix, payload) tuple and
+    the text between or after literals (e.g. b")") as plain bytes.
+    """
+    messages: list[tuple[bytes, list[bytes]]] = []
+    for item in data:
+        prefix, literal = item if isinstance(item, tuple) else (item, None)
+        if not prefix:
+            continue
+        if _FETCH_START_RE.match(prefix) or not messages:
+            messages.append((b"", []))
+        meta, literals = messages[-1]
+        if literal is not None:
+            literals.append(literal)
+        messages[-1] = (meta + prefix, literals)
+    return messages
+
+
+_MSGID_RE = re.compile(r"<[^>]+>")
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_date(d):
+    try:
+        parsed = email.utils.parsedate_to_datetime(d)
+    except Exception:
+        return None
+    # "-0000" zones parse as naive datetimes, which can't be compared with aware ones
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=datetime.timezone.utc)
+
+
+# Thread messages never change once sent, so each one is fetched and parsed only
+# once: Message-ID -> (date, from, body truncated to THREAD_BODY_CHARS, references).
+THREAD_BODY_CHARS = 800
+_THREAD_CACHE_SIZE = 10_000
+_thread_cache: OrderedDict[str, tuple[str, str, str, tuple[str, ...]]] = OrderedDict()
+_thread_cache_lock = threading.Lock()
+
 
+def _get_thread_message(msg_id: str):
+    with _thread_cache_lock:
+        entry = _thread_cache.get(msg_id)
+        if entry is not None:
+            _thread_cache.move_to_end(msg_id)
+        return entry
 
-def fetch_thread_history(imap, msg, max_messages: int = 10, max_body_chars: int = 800) -> str:
+
+def _remember_thread_message(msg_id: str, date_: str, from_: str, body_: str, refs) -> None:
+    if not msg_id:
+        return
+    with _thread_cache_lock:
+        _thread_cache[msg_id] = (date_, from_, body_[:THREAD_BODY_CHARS], tuple(refs))
+        _thread_cache.move_to_end(msg_id)
+        if len(_thread_cache) > _THREAD_CACHE_SIZE:
+            _thread_cache.popitem(last=False)
+
+
+_QUOTE_ATTRIBUTION_RE = re.compile(r"^On .* wrote:$")
+# Chunk boundary after lines whose hash has these bits clear (~1 line in 4): small
+# enough for 800-char bodies to split into several chunks. crc32 rather than hash()
+# so boundaries, and therefore the prompt, are the same across restarts.
+_CHUNK_MASK = 0x3
+
+
+def dedupe_thread_bodies(bodies: list[str]) -> list[str]:
+    """
+    Compact thread bodies for the prompt: drop quoted lines and "On ... wrote:"
+    attributions, cut each body into content-defined chunks and replace chunks
+    already present in an earlier message with a pointer to that message.
+    """
+    seen: dict[bytes, int] = {}  # chunk digest -> 1-based index of first message containing it
+    compacted = []
+    for i, body in enumerate(bodies, 1):
+        lines = [
+            line for line in body.splitlines()
+            if not line.lstrip().startswith(">") and not _QUOTE_ATTRIBUTION_RE.match(line.strip())
+        ]
+        chunks: list[list[str]] = [[]]
+        for line in lines:
+            chunks[-1].append(line)
+            if zlib.crc32(line.strip().encode()) & _CHUNK_MASK == 0:
+                chunks.append([])
+
+        kept: list[str] = []
+        for chunk in chunks:
+            normalized = "\n".join(line.strip() for line in chunk).strip()
+            if not normalized:
+                kept.extend(chunk)
+                continue
+            digest = hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+            first = seen.setdefault(digest, i)
+            if first == i:
+                kept.extend(chunk)
+            else:
+                marker = f"[dedup: see message {first}]"
+                if not kept or kept[-1] != marker:
+                    kept.append(marker)
+        compacted.append("\n".join(kept).strip())
+    return compacted
+
+
+# References normally lists the whole chain, so the first round finds everything;
+# one more round picks up ancestors that only the fetched messages mention.
+_THREAD_SEARCH_ROUNDS = 2
+
+
+def _quote(value: str) -> str:
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _message_id_criteria(msg_ids: list[str]) -> list[str]:
+    """SEARCH criteria matching any of msg_ids: OR HEADER Message-ID a OR HEADER Message-ID b ..."""
+    criteria = ["HEADER", "Message-ID", _quote(msg_ids[-1].strip("<>"))]
+    for msg_id in reversed(msg_ids[:-1]):
+        criteria = ["OR", "HEADER", "Message-ID", _quote(msg_id.strip("<>"))] + criteria
+    return criteria
+
+
+def _fetch_thread_messages(imap, msg_ids: list[str], text_bytes: int) -> dict:
+    """Look up msg_ids with one UID SEARCH + one UID FETCH per folder; return Message-ID -> message."""
+    found: dict = {}
+    for folder in imap_session.folders:
+        remaining = [m for m in msg_ids if m not in found]
+        if not remaining:
+            break
+        try:
+            status, _ = imap.select(folder, readonly=True)
+            log.debug(f"[thread] SELECT {folder!r} → {status}")
+            if status != "OK":
+                continue
+            _, uids = imap.uid("SEARCH", *_message_id_criteria(remaining))
+            log.debug(f"[thread] SEARCH {len(remaining)} id(s) in {folder!r} → {uids}")
+            if not uids[0]:
+                continue
+            _, data = imap.uid("FETCH", b",".join(uids[0].split()), _peek_fetch_items(text_bytes))
+            wanted = set(remaining)
+            for _, literals in split_fetch_response(data):
+                if not literals:
+                    continue
+                prev = _parse(b"".join(literals))
+                prev_id = (prev.get("Message-ID") or "").strip()
+                if prev_id in wanted and prev_id not in found:
+                    log.debug(f"[thread] Found {prev_id!r} in {folder!r}")
+                    found[prev_id] = prev
+        except Exception as exc:
+            log.debug(f"[thread] Error searching {folder!r}: {exc}")
+    return found
+
+
+def fetch_thread_history(imap, msg, max_messages: int = 10) -> str:
     """
     Reconstruct the full conversation thread by following References + In-Reply-To
     headers recursively, so the original message is always included.
@@ -340,141 +868,413 @@ def fetch_thread_history(imap, msg, max_messages: int = 10, max_body_chars: int
     log.debug(f"[thread] In-Reply-To: {in_reply_to!r}")
 
     # Start with the explicitly listed references
-    all_refs = re.findall(r"<[^>]+>", references + " " + in_reply_to)
+    all_refs = _MSGID_RE.findall(references + " " + in_reply_to)
     if not all_refs:
         log.debug("[thread] No message-id references found; skipping thread fetch.")
         return ""
 
-    # Deduplicate, keep order
+    log.debug(f"[thread] Folders to search: {imap_session.folders}")
+
+    history_msgs: list[tuple[str, str, str, str]] = []  # (date, message-id, from, body) for sorting
+
+    # Every ID is enqueued at most once, so seen_ids doubles as the processed set
     seen_ids: set = set()
-    queue = [r for r in all_refs if not (r in seen_ids or seen_ids.add(r))]
-    log.debug(f"[thread] Folders to search: {_folders_to_search}")
+    queue: deque[str] = deque()
 
-    history_msgs: list[tuple[str, str, str]] = []  # (date, from, body) for sorting
+    def enqueue(refs):
+        for ref in refs:
+            if ref not in seen_ids:
+                seen_ids.add(ref)
+                queue.append(ref)
 
-    # BFS: fetch each referenced message; if it has further References, enqueue those too
-    processed: set = set()
-    while queue and len(history_msgs) < max_messages:
-        msg_id = queue.pop(0)
-        if msg_id in processed:
-            continue
-        processed.add(msg_id)
+    enqueue(all_refs)
 
-        found = False
-        for folder in _folders_to_search:
-            try:
-                status, data = imap.select(folder, readonly=True)
-                log.debug(f"[thread] SELECT {folder!r} → {status}")
-                if status != "OK":
-                    continue
-                _, uids = imap.search(None, "HEADER", "Message-ID", msg_id.strip("<>"))
-                log.debug(f"[thread] SEARCH {msg_id!r} in {folder!r} → {uids}")
-                if not uids[0]:
-                    continue
-                uid = uids[0].split()[-1]
-                _, data = imap.fetch(uid, "(RFC822)")
-                raw = data[0][1]
-                prev = email.message_from_bytes(raw)
-                from_ = decode_str(prev["From"])
-                date_ = prev.get("Date", "")
-                body_ = (get_body(prev) or "")[:max_body_chars]
-                log.debug(f"[thread] Found {msg_id!r} from {from_!r} in {folder!r}")
-                history_msgs.append((date_, from_, body_))
-
-                # Enqueue any further ancestors this message references
-                prev_refs = re.findall(r"<[^>]+>", (prev.get("References") or "") + " " + (prev.get("In-Reply-To") or ""))
-                for ref in prev_refs:
-                    if ref not in seen_ids:
-                        seen_ids.add(ref)
-                        queue.append(ref)
-
-                found = True
-                break
-            except Exception as exc:
-                log.debug(f"[thread] Error searching {folder!r} for {msg_id!r}: {exc}")
+    # BFS in rounds: resolve what the cache knows, then look up everything else
+    # with one search per folder; ancestors found there are enqueued for the next round
+    rounds = 0
+    while queue and len(history_msgs) < max_messages:
+        pending: list[str] = []
+        while queue and len(history_msgs) + len(pending) < max_messages:
+            msg_id = queue.popleft()
+            cached = _get_thread_message(msg_id)
+            if cached is None:
+                pending.append(msg_id)
                 continue
-        if not found:
-            log.debug(f"[thread] {msg_id!r} not found in any folder.")
+            date_, from_, body_, prev_refs = cached
+            log.debug(f"[thread] Cache hit for {msg_id!r}")
+            history_msgs.append((date_, msg_id, from_, body_))
+            enqueue(prev_refs)
+
+        if not pending or rounds == _THREAD_SEARCH_ROUNDS:
+            break
+        rounds += 1
+
+        # Leave room for the MIME preamble, part headers and transfer-encoding overhead
+        found = _fetch_thread_messages(imap, pending, text_bytes=THREAD_BODY_CHARS * 4 + 2048)
+        for msg_id in pending:
+            prev = found.get(msg_id)
+            if prev is None:
+                log.debug(f"[thread] {msg_id!r} not found in any folder.")
+                continue
+            from_ = decoded_header(prev, "From")
+            date_ = prev.get("Date", "")
+            body_ = get_body(prev) or ""
+            history_msgs.append((date_, msg_id, from_, body_[:THREAD_BODY_CHARS]))
+
+            # Enqueue any further ancestors this message references
+            prev_refs = _MSGID_RE.findall((prev.get("References") or "") + " " + (prev.get("In-Reply-To") or ""))
+            _remember_thread_message(msg_id, date_, from_, body_, prev_refs)
+            enqueue(prev_refs)
 
     # Restore INBOX for the caller
     imap.select("INBOX")
 
-    # Sort by Date ascending so the prompt reads oldest → newest
-    def _parse_date(d):
-        try:
-            return email.utils.parsedate_to_datetime(d)
-        except Exception:
-            return None
-
-    history_msgs.sort(key=lambda t: (_parse_date(t[0]) is None, _parse_date(t[0])))
-
-    parts = [f"--- From: {f} | Date: {d}\n{b}" for d, f, b in history_msgs]
+    # Sort by Date ascending so the prompt reads oldest → newest; Message-ID breaks
+    # ties so the same thread always renders to the same string. Each Date is
+    # parsed once up front rather than inside the sort key.
+    decorated = [(_parse_date(t[0]), t[1], i) for i, t in enumerate(history_msgs)]
+    decorated.sort(key=lambda x: (x[0] is None, x[0], x[1]))
+    history_msgs = [history_msgs[i] for _, _, i in decorated]
+
+    bodies = dedupe_thread_bodies([b for _, _, _, b in history_msgs])
+    parts = [
+        f"--- Message {i} | From: {f} | Date: {d}\n{b}"
+        for i, ((d, _, f, _), b) in enumerate(zip(history_msgs, bodies), 1)
+    ]
     log.debug(f"[thread] Returning {len(parts)} historical message(s).")
     return "\n\n".join(parts)
 
 
+_IMAP_ATOM_RE = re.compile(rb'[^\s()"{]+')
+
+
+def _parse_imap_list(data: bytes, pos: int = 0):
+    """
+    Parse the parenthesized IMAP list starting at data[pos] (e.g. a BODYSTRUCTURE)
+    into nested Python lists of str/None. Returns (value, end position).
+    Literals are not supported and raise ValueError.
+    """
+    if data[pos:pos + 1] != b"(":
+        raise ValueError(f"expected '(' at {pos}")
+    items: list = []
+    pos += 1
+    while True:
+        while data[pos:pos + 1].isspace():
+            pos += 1
+        c = data[pos:pos + 1]
+        if c == b")":
+            return items, pos + 1
+        if c == b"(":
+            item, pos = _parse_imap_list(data, pos)
+            items.append(item)
+        elif c == b'"':
+            buf = bytearray()
+            pos += 1
+            while data[pos:pos + 1] != b'"':
+                if not data[pos:pos + 1]:
+                    raise ValueError("unterminated string")
+                if data[pos:pos + 1] == b"\\":
+                    pos += 1
+                buf += data[pos:pos + 1]
+                pos += 1
+            items.append(buf.decode("utf-8", errors="replace"))
+            pos += 1
+        else:
+            atom = _IMAP_ATOM_RE.match(data, pos)
+            if not atom:
+                raise ValueError(f"unexpected {c!r} at {pos}")
+            items.append(None if atom.group().upper() == b"NIL" else atom.group().decode())
+            pos = atom.end()
+
+
+def _find_text_plain(part: list, section: str = ""):
+    """Return (section, encoding, charset) of the first text/plain leaf of a BODYSTRUCTURE, or None."""
+    if part and isinstance(part[0], list):
+        # multipart: the child parts come first, then the subtype and extension data
+        for n, child in enumerate(itertools.takewhile(lambda p: isinstance(p, list), part), 1):
+            found = _find_text_plain(child, f"{section}.{n}" if section else str(n))
+            if found:
+                return found
+        return None
+    if (part[0] or "").lower() != "text" or (part[1] or "").lower() != "plain":
+        return None
+    params = part[2] or []
+    charset = next((v for k, v in zip(params[::2], params[1::2]) if (k or "").lower() == "charset"), None)
+    return section or "1", part[5], charset
+
+
+def _decode_part(payload: bytes, encoding, charset) -> str:
+    encoding = (encoding or "7bit").lower()
+    if encoding == "base64":
+        # Drop line breaks; a partial fetch may also cut the last 4-char group short
+        data = re.sub(rb"[^A-Za-z0-9+/=]", b"", payload)
+        payload = base64.b64decode(data[:len(data) - len(data) % 4])
+    elif encoding == "quoted-printable":
+        payload = quopri.decodestring(payload)
+    try:
+        return payload.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        return payload.decode("utf-8", errors="replace")
+
+
+def _fetch_by_bodystructure(imap, uid_list: list[bytes]) -> dict[bytes, ParsedEmail]:
+    """
+    Fetch headers + only the first text/plain part of each message. BODYSTRUCTURE
+    locates the part, which is then fetched and decoded directly, so the MIME tree
+    is never parsed. Messages whose structure can't be used go through _parse().
+    """
+    _, data = imap.uid("FETCH", b",".join(uid_list), "(BODYSTRUCTURE BODY.PEEK[HEADER])")
+    messages: dict[bytes, ParsedEmail] = {}
+    text_parts: dict[bytes, tuple] = {}  # uid -> (section, encoding, charset)
+    fallback: list[bytes] = []
+    for meta, literals in split_fetch_response(data):
+        uid_match = _FETCH_UID_RE.search(meta)
+        if not uid_match or not literals:
+            continue  # unsolicited FETCH response, e.g. a flag update
+        uid = uid_match.group(1)
+        try:
+            structure, _ = _parse_imap_list(meta, meta.index(b"BODYSTRUCTURE ") + len(b"BODYSTRUCTURE "))
+            text_part = _find_text_plain(structure)
+        except (ValueError, IndexError) as e:
+            log.debug(f"Unusable BODYSTRUCTURE for UID {uid!r}: {e}")
+            text_part = None
+        if text_part is None:
+            fallback.append(uid)
+            continue
+        messages[uid] = _parse(literals[0])
+        text_parts[uid] = text_part
+
+    # Messages sharing a section (usually "1") are fetched together
+    by_section: dict[str, list[bytes]] = {}
+    for uid, (section, _, _) in text_parts.items():
+        by_section.setdefault(section, []).append(uid)
+    for section, uids in by_section.items():
+        _, data = imap.uid("FETCH", b",".join(uids), f"(BODY.PEEK[{section}]<0.{BODY_FETCH_BYTES}>)")
+        payloads = {}
+        for meta, literals in split_fetch_response(data):
+            uid_match = _FETCH_UID_RE.search(meta)
+            if uid_match and literals:
+                payloads[uid_match.group(1)] = literals[0]
+        for uid in uids:
+            _, encoding, charset = text_parts[uid]
+            try:
+                messages[uid].text_body = _decode_part(payloads[uid], encoding, charset)
+            except (KeyError, ValueError) as e:
+                log.debug(f"Could not decode text part of UID {uid!r}: {e}")
+                del messages[uid]
+                fallback.append(uid)
+
+    if fallback:
+        _, data = imap.uid("FETCH", b",".join(fallback), _peek_fetch_items())
+        for meta, literals in split_fetch_response(data):
+            uid_match = _FETCH_UID_RE.search(meta)
+            if uid_match and literals:
+                messages[uid_match.group(1)] = _parse(b"".join(literals))
+    return messages
+
+
 def fetch_unseen_emails(imap):
     imap.select("INBOX")
-    _, uids = imap.search(None, "UNSEEN")
+    _, uids = imap.uid("SEARCH", None, "UNSEEN")
+    uid_list = uids[0].split()
+    if not uid_list:
+        return []
+    imap_session.highest_uid = max(imap_session.highest_uid, *map(int, uid_list))
+
+    messages = _fetch_by_bodystructure(imap, uid_list)
+    # Only mark what was actually fetched; anything else stays unseen for the next pass
+    fetched = [uid for uid in uid_list if uid in messages]
+    missing = [uid for uid in uid_list if uid not in messages]
+    if missing:
+        log.warning(f"Could not fetch {len(missing)} unseen email(s), leaving them unseen: {b' '.join(missing).decode()}")
+    if fetched:
+        imap.uid("STORE", b",".join(fetched), "+FLAGS", "\\Seen")
+
     emails = []
-    for uid in uids[0].split():
-        _, data = imap.fetch(uid, "(RFC822)")
-        raw = data[0][1]
-        msg = email.message_from_bytes(raw)
+    for uid in fetched:
+        msg = messages[uid]
         thread_history = fetch_thread_history(imap, msg)
         incoming_msg_id = (msg.get("Message-ID") or "").strip()
         incoming_refs   = (msg.get("References") or "").strip()
+        body = get_body(msg)
+        # The next email in this thread will list this one as an ancestor
+        _remember_thread_message(
+            incoming_msg_id, msg.get("Date", ""), decoded_header(msg, "From"), body,
+            _MSGID_RE.findall(incoming_refs + " " + (msg.get("In-Reply-To") or "")),
+        )
         emails.append({
             "uid": uid.decode(),
-            "sender": decode_str(msg["From"]),
-            "subject": decode_str(msg["Subject"]),
-            "body": get_body(msg),
+            "sender": decoded_header(msg, "From"),
+            "subject": decoded_header(msg, "Subject"),
+            "body": body,
             "message_id": incoming_msg_id,
             "references": incoming_refs,
             "thread_history": thread_history,
             "is_auto_reply": is_auto_reply_email(msg),
+            "raw_headers": frozenset(msg.headers),
         })
-        # Mark as seen
-        imap.store(uid, "+FLAGS", "\\Seen")
     return emails
 
 
 # ── Main Loop ──────────────────────────────────────────────────────────────────
 
-def run():
+# RFC 2177: clients should re-issue IDLE at least every 29 minutes
+IDLE_TIMEOUT_SECONDS = 29 * 60
+
+
+def _has_buffered_data(imap) -> bool:
+    """
+    True if a read would return data right away. imaplib reads through a buffered
+    file, so lines that arrived with an earlier one wait there, invisible to select().
+    """
+    sock = imap.sock
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        # peek() returns the buffer without I/O if it is non-empty; otherwise it does a
+        # single non-blocking read, which also drains TLS records already decrypted
+        return bool(imap.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+def _wait_readable(imap, timeout: float) -> bool:
+    """Block until the server sends data on the IMAP socket or the timeout expires."""
+    if _has_buffered_data(imap):
+        return True
+    readable, _, _ = select.select([imap.sock], [], [], timeout)
+    return bool(readable)
+
+
+def has_pending_mail(imap) -> bool:
+    """
+    True if unseen mail arrived after the last fetch_unseen_emails(). While a batch
+    is processed, new mail is announced in responses to other commands (or dropped
+    by the next SELECT) and is never announced again, so look for it before waiting.
+    UIDs already returned by an earlier search, e.g. messages that could not be
+    fetched, don't count.
+    """
+    imap.select("INBOX")
+    for name in ("EXISTS", "RECENT"):
+        imap.untagged_responses.pop(name, None)
+    _, uids = imap.uid("SEARCH", None, "UNSEEN", f"UID {imap_session.highest_uid + 1}:*")
+    # "n:*" always matches the last message, even when its UID is below n
+    if any(int(uid) > imap_session.highest_uid for uid in uids[0].split()):
+        return True
+    # Mail delivered while the SEARCH ran may only show up as EXISTS in its response
+    return "EXISTS" in imap.untagged_responses or "RECENT" in imap.untagged_responses
+
+
+def idle(imap, timeout: float = IDLE_TIMEOUT_SECONDS) -> bool:
+    """
+    Issue IMAP IDLE and block until the server reports new mail (EXISTS/RECENT)
+    or the timeout expires. Returns True if new mail was announced.
+    """
+    tag = imap._new_tag()
+    imap.send(tag + b" IDLE\r\n")
+    resp = imap.readline()
+    if not resp.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"IDLE rejected: {resp!r}")
+    log.debug("[idle] Waiting for new mail")
+
+    new_mail = False
+    deadline = time.monotonic() + timeout
+    while not new_mail:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not _wait_readable(imap, remaining):
+            break
+        line = imap.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        log.debug(f"[idle] {line!r}")
+        new_mail = line.startswith(b"*") and (b"EXISTS" in line or b"RECENT" in line)
+
+    imap.send(b"DONE\r\n")
+    while True:
+        line = imap.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed while ending IDLE")
+        if line.startswith(tag):
+            break
+    return new_mail
+
+
+def poll_wait(imap, timeout: float) -> None:
+    """
+    Fallback for servers without IDLE: block on the socket until the server sends
+    anything or the timeout expires, instead of sleeping blindly. Returns at once
+    if mail arrived while the last batch was processed.
+    """
+    if has_pending_mail(imap):
+        return
+    _wait_readable(imap, timeout)
+
+
+async def process_emails(emails) -> None:
+    """Run the agent on all emails concurrently, at most Config.MAX_CONCURRENCY at a time."""
+    semaphore = asyncio.Semaphore(getattr(Config, "MAX_CONCURRENCY", 4))
+
+    async def process(e):
+        state: EmailState = {
+            "uid": e["uid"],
+            "sender": e["sender"],
+            "subject": e["subject"],
+            "body": e["body"],
+            "message_id": e["message_id"],
+            "references": e["references"],
+            "thread_history": e["thread_history"],
+            "is_auto_reply": e["is_auto_reply"],
+            "raw_headers": e["raw_headers"],
+            "should_reply": False,
+            "dedup_key": "",
+            "reply_body": "",
+            "error": "",
+        }
+        async with semaphore:
+            await agent.ainvoke(state)
+
+    async def process_in_order(group):
+        for e in group:
+            try:
+                await process(e)
+            except Exception as exc:
+                log.error(f"Failed to process email {e['uid']}: {exc}")
+
+    # Echoes and double deliveries usually arrive in the same batch. Emails with the
+    # same reply-cache key run one after another, so later copies find the first
+    # one's reply in the cache instead of calling the LLM again.
+    groups: dict[str, list] = {}
+    for e in emails:
+        key = reply_cache_key(e["sender"], e["subject"], e["body"], e["thread_history"])
+        groups.setdefault(key, []).append(e)
+    await asyncio.gather(*(process_in_order(group) for group in groups.values()))
+
+
+async def run():
     log.info(f"Agent starting. Monitoring {Config.EMAIL_ADDRESS}")
-    ctx = ssl.create_default_context()
-    with imaplib.IMAP4_SSL(Config.IMAP_HOST, Config.IMAP_PORT, ssl_context=ctx) as imap:
-        imap.login(Config.EMAIL_ADDRESS, Config.EMAIL_PASSWORD)
-        detect_folders(imap)
     while True:
         try:
-            ctx = ssl.create_default_context()
-            with imaplib.IMAP4_SSL(Config.IMAP_HOST, Config.IMAP_PORT, ssl_context=ctx) as imap:
-                imap.login(Config.EMAIL_ADDRESS, Config.EMAIL_PASSWORD)
-                emails = fetch_unseen_emails(imap)
-
+            # IMAP calls block the event loop, but nothing else is scheduled while
+            # they run: emails are only processed between fetch and idle.
+            imap = imap_session.connect()
+            emails = fetch_unseen_emails(imap)
             log.info(f"Found {len(emails)} unseen email(s)")
-            for e in emails:
-                state: EmailState = {
-                    "uid": e["uid"],
-                    "sender": e["sender"],
-                    "subject": e["subject"],
-                    "body": e["body"],
-                    "message_id": e["message_id"],
-                    "references": e["references"],
-                    "thread_history": e["thread_history"],
-                    "is_auto_reply": e["is_auto_reply"],
-                    "should_reply": False,
-                    "reply_body": "",
-                    "error": "",
-                }
-                agent.invoke(state)
+            await process_emails(emails)
+
+            # send_reply may have replaced a broken connection while processing
+            imap = imap_session.connect()
+            if imap_session.use_idle:
+                if not has_pending_mail(imap):
+                    idle(imap)
+            else:
+                poll_wait(imap, Config.POLL_INTERVAL_SECONDS)
 
         except Exception as e:
             log.error(f"Poll error: {e}")
-
-        time.sleep(Config.POLL_INTERVAL_SECONDS)
+            imap_session.drop()
+            await asyncio.sleep(Config.POLL_INTERVAL_SECONDS)
 
 
 if __name__ == "__main__":
@@ -486,4 +1286,4 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
     load_config(args.config)
-    run()
+    asyncio.run(run())